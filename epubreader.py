@@ -1,20 +1,19 @@
 import sys
 import os
 import base64
+import json
 import sqlite3
+import time
 from pathlib import Path
 
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton,
     QTextBrowser, QFileDialog, QListWidget, QSplitter, QComboBox,
-    QMainWindow, QAction, QSizePolicy
+    QMainWindow, QAction, QSizePolicy, QLabel,
+    QStackedWidget
 )
-from PyQt5.QtGui import QFont
-from PyQt5.QtCore import Qt
-
-import ebooklib
-from ebooklib import epub
-from bs4 import BeautifulSoup
+from PyQt5.QtGui import QFont, QPixmap
+from PyQt5.QtCore import Qt, QTimer, QEvent
 
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -22,6 +21,46 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 import os
 os.environ["QT_LOGGING_RULES"] = "qt.qpa.fonts=false"
 
+# Parsing libraries are imported when the first book is opened,
+# so the window shows up without paying for them
+ebooklib = None
+epub = None
+BeautifulSoup = None
+LexborHTMLParser = None
+HTML_PARSER = "html.parser"
+
+
+def load_parsers():
+    global ebooklib, epub, BeautifulSoup, LexborHTMLParser, HTML_PARSER
+    if ebooklib is not None:
+        return
+
+    from bs4 import BeautifulSoup
+
+    # ebooklib already depends on lxml; the fallback is defensive only
+    try:
+        import lxml
+        HTML_PARSER = "lxml"
+    except ImportError:
+        HTML_PARSER = "html.parser"
+
+    try:
+        from selectolax.lexbor import LexborHTMLParser
+    except ImportError:
+        LexborHTMLParser = None
+
+    from ebooklib import epub
+    import ebooklib
+
+
+PAGE_LABEL = "Page %d / %d"
+
+# Bump when parse_chapters/parse_document/embed_images output changes
+CHAPTER_CACHE_VERSION = 1
+# Number of most recently opened books whose chapters stay cached
+CHAPTER_CACHE_BOOKS = 10
+
+
 class EpubReader(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -29,11 +68,15 @@ class EpubReader(QMainWindow):
         self.resize(1000, 700)
 
         self.chapters = []
-        self.pages = []
+        self.page_blocks = []
+        self.page_starts = []
+        self.page_html_cache = {}
         self.current_chapter = 0
         self.current_page = 0
+        self.restored_page = 0
         self.font_size = 14
         self.cover_data = None
+        self.cover_pixmap = None
         self.current_book = None
         self.images = {}
         self.book = None
@@ -48,6 +91,12 @@ class EpubReader(QMainWindow):
 
         self.init_database()
 
+        # Coalesce progress writes while pages are flipped quickly
+        self.pending_progress = None
+        self.save_timer = QTimer(self)
+        self.save_timer.setSingleShot(True)
+        self.save_timer.timeout.connect(self.flush_progress)
+
         # UI SETUP
         menu = self.menuBar()
         file_menu = menu.addMenu("File")
@@ -68,9 +117,36 @@ class EpubReader(QMainWindow):
         splitter.addWidget(self.chapter_list)
 
         self.text_view = QTextBrowser()
-        self.text_view.setFont(QFont("Times New Roman", self.font_size))
+        self.view_font = QFont("Times New Roman", self.font_size)
+        self.text_view.setFont(self.view_font)
         self.text_view.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
-        splitter.addWidget(self.text_view)
+
+        # Page footer lives outside the document so page turns only set the page body
+        self.footer_label = QLabel()
+        self.footer_label.setTextFormat(Qt.PlainText)
+        self.footer_label.setAlignment(Qt.AlignCenter)
+        footer_font = self.footer_label.font()
+        footer_font.setBold(True)
+        self.footer_label.setFont(footer_font)
+
+        reader_pane = QWidget()
+        reader_layout = QVBoxLayout(reader_pane)
+        reader_layout.setContentsMargins(0, 0, 0, 0)
+        # Chapters are HTML with inline images, so they stay in a QTextBrowser;
+        # the stack lets other page kinds use lighter widgets
+        self.viewer_stack = QStackedWidget()
+        self.viewer_stack.addWidget(self.text_view)
+
+        self.cover_label = QLabel()
+        self.cover_label.setAlignment(Qt.AlignCenter)
+        self.cover_label.setStyleSheet("background-color:#202020;")
+        self.cover_label.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
+        # Rescale on the label's own resizes, which include splitter drags
+        self.cover_label.installEventFilter(self)
+        self.viewer_stack.addWidget(self.cover_label)
+        reader_layout.addWidget(self.viewer_stack)
+        reader_layout.addWidget(self.footer_label)
+        splitter.addWidget(reader_pane)
 
         splitter.setSizes([200, 800])
         main_layout.addWidget(splitter)
@@ -106,39 +182,90 @@ class EpubReader(QMainWindow):
 
     # DATABASE
     def init_database(self):
-        conn = sqlite3.connect(self.db_path)
-        cur = conn.cursor()
-        cur.execute("""
+        # One connection for the whole session, in autocommit mode
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        # WAL is stored in the database file, the rest are per connection
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA cache_size=-10000")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("""
             CREATE TABLE IF NOT EXISTS progress (
                 book_path TEXT PRIMARY KEY,
                 chapter INTEGER,
                 page INTEGER
             )
         """)
-        conn.commit()
-        conn.close()
+        # Rows from builds without a version column can't be trusted
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(chapters_cache)")}
+        if columns and "version" not in columns:
+            self.conn.execute("DROP TABLE chapters_cache")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS chapters_cache (
+                book_path TEXT PRIMARY KEY,
+                mtime REAL,
+                size INTEGER,
+                version INTEGER,
+                opened REAL,
+                chapters BLOB
+            )
+        """)
 
     def save_progress(self, book_path, chapter, page):
-        conn = sqlite3.connect(self.db_path)
-        cur = conn.cursor()
-        cur.execute("""
+        self.conn.execute("""
             INSERT INTO progress (book_path, chapter, page)
             VALUES (?, ?, ?)
             ON CONFLICT(book_path) DO UPDATE SET
                 chapter=excluded.chapter,
                 page=excluded.page
         """, (book_path, chapter, page))
-        conn.commit()
-        conn.close()
+
+    def schedule_progress_save(self, book_path, chapter, page):
+        self.pending_progress = (book_path, chapter, page)
+        self.save_timer.start(500)
+
+    def flush_progress(self):
+        self.save_timer.stop()
+        if self.pending_progress:
+            self.save_progress(*self.pending_progress)
+            self.pending_progress = None
 
     def load_progress(self, book_path):
-        conn = sqlite3.connect(self.db_path)
-        cur = conn.cursor()
-        cur.execute("SELECT chapter, page FROM progress WHERE book_path=?", (book_path,))
-        row = cur.fetchone()
-        conn.close()
+        row = self.conn.execute(
+            "SELECT chapter, page FROM progress WHERE book_path=?", (book_path,)
+        ).fetchone()
         return row if row else (0, 0)
 
+    def load_cached_chapters(self, book_path, mtime, size):
+        row = self.conn.execute("""
+            SELECT chapters FROM chapters_cache
+            WHERE book_path=? AND mtime=? AND size=? AND version=?
+        """, (book_path, mtime, size, CHAPTER_CACHE_VERSION)).fetchone()
+        if not row:
+            return None
+
+        self.conn.execute(
+            "UPDATE chapters_cache SET opened=? WHERE book_path=?", (time.time(), book_path)
+        )
+        return json.loads(row[0])
+
+    def save_cached_chapters(self, book_path, mtime, size, chapters):
+        self.conn.execute("""
+            INSERT OR REPLACE INTO chapters_cache (book_path, mtime, size, version, opened, chapters)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (book_path, mtime, size, CHAPTER_CACHE_VERSION, time.time(), json.dumps(chapters)))
+        # Chapters carry inlined images, so only keep the most recent books
+        self.conn.execute("""
+            DELETE FROM chapters_cache WHERE book_path NOT IN (
+                SELECT book_path FROM chapters_cache ORDER BY opened DESC LIMIT ?
+            )
+        """, (CHAPTER_CACHE_BOOKS,))
+
+    def closeEvent(self, event):
+        self.flush_progress()
+        self.conn.close()
+        super().closeEvent(event)
+
     # EPUB LOADING
     def open_epub(self):
         file_path, _ = QFileDialog.getOpenFileName(
@@ -165,50 +292,64 @@ class EpubReader(QMainWindow):
         if href in self.toc_map:
             return self.toc_map[href]
 
-        soup = BeautifulSoup(item.get_content(), "html.parser")
+        # Only the <title> text is needed here, no tree to keep around
+        if LexborHTMLParser is not None:
+            title = LexborHTMLParser(item.get_content()).css_first("title")
+            if title is not None and title.text(strip=True):
+                return title.text(strip=True)
+            return default_title
+
+        soup = BeautifulSoup(item.get_content(), HTML_PARSER)
         if soup.title and soup.title.string:
             return soup.title.string.strip()
 
         return default_title
 
     def load_epub(self, path):
+        # Write the previous book's position before it can be overwritten
+        self.flush_progress()
+        load_parsers()
         self.current_book = os.path.abspath(path)
-        self.book = epub.read_epub(path)
 
         self.chapters.clear()
-        self.chapter_list.clear()
         self.cover_data = None
-        self.images.clear()
-        self.toc_map = {}
-
-        self.build_toc_map(self.book.toc)
-
-        # Load images
-        for item in self.book.get_items():
-            if item.get_type() == ebooklib.ITEM_IMAGE:
-                self.images[item.get_name()] = item.get_content()
+        self.cover_pixmap = None
+        self.cover_label.clear()
 
         # Load cover.jpg from same folder
         cover_path = os.path.join(os.path.dirname(path), "cover.jpg")
         if os.path.exists(cover_path):
             with open(cover_path, "rb") as f:
                 self.cover_data = f.read()
+            self.cover_pixmap = QPixmap()
+            # An undecodable cover gets no cover page at all
+            if not self.cover_pixmap.loadFromData(self.cover_data):
+                self.cover_data = None
+                self.cover_pixmap = None
+
+        # Reuse parsed chapters while the file is unchanged
+        stat = os.stat(self.current_book)
+        entries = self.load_cached_chapters(self.current_book, stat.st_mtime, stat.st_size)
+        if entries is None:
+            entries = self.parse_chapters(path)
+            self.save_cached_chapters(self.current_book, stat.st_mtime, stat.st_size, entries)
+
+        titles = []
+        if self.cover_data:
+            self.chapters.append("__COVER__")
+            titles.append("Cover Page")
 
-        chapter_counter = 1
-
-        for item in self.book.get_items():
-            if item.get_type() == ebooklib.ITEM_DOCUMENT:
-                soup = BeautifulSoup(item.get_content(), "html.parser")
-                html = self.embed_images(str(soup))
-                if html.strip():
-                    title = self.extract_title(item, f"Chapter {chapter_counter}")
-                    self.chapters.append(html)
-                    self.chapter_list.addItem(title)
-                    chapter_counter += 1
+        for title, html in entries:
+            self.chapters.append(html)
+            titles.append(title)
 
-        if self.cover_data:
-            self.chapters.insert(0, "__COVER__")
-            self.chapter_list.insertItem(0, "Cover Page")
+        # Refill the list in one go without repaints or row-change signals
+        self.chapter_list.setUpdatesEnabled(False)
+        self.chapter_list.blockSignals(True)
+        self.chapter_list.clear()
+        self.chapter_list.addItems(titles)
+        self.chapter_list.blockSignals(False)
+        self.chapter_list.setUpdatesEnabled(True)
 
         chapter, page = self.load_progress(self.current_book)
 
@@ -218,12 +359,53 @@ class EpubReader(QMainWindow):
         self.current_page = page
         self.suppress_load = False
 
+        # Only the chapter opened here resumes at the saved page
+        self.restored_page = page
         self.load_chapter(chapter)
-        self.current_page = min(page, len(self.pages) - 1)
-        self.display_page()
+
+    def parse_chapters(self, path):
+        self.book = epub.read_epub(path)
+
+        self.images.clear()
+        self.toc_map = {}
+
+        self.build_toc_map(self.book.toc)
+
+        # Single pass over the manifest; documents are processed afterwards
+        # because they may reference images listed later
+        documents = []
+        for item in self.book.get_items():
+            item_type = item.get_type()
+            if item_type == ebooklib.ITEM_IMAGE:
+                self.images[item.get_name()] = item.get_content()
+            elif item_type == ebooklib.ITEM_DOCUMENT:
+                documents.append(item)
+
+        entries = []
+        chapter_counter = 1
+
+        for item in documents:
+            html, title = self.parse_document(item)
+            if html.strip():
+                entries.append((title or f"Chapter {chapter_counter}", html))
+                chapter_counter += 1
+
+        return entries
+
+    def parse_document(self, item):
+        # lxml's HTML mode can drop content after an XHTML prolog,
+        # so hand it the body markup only. get_body_content() returns ''
+        # for text-only bodies and on parse errors; use the full document
+        # then, otherwise the chapter would be dropped and shift the indices
+        content = None
+        if HTML_PARSER == "lxml":
+            content = item.get_body_content()
+        if not content:
+            content = item.get_content()
+        return self.embed_images(content), self.extract_title(item, None)
 
     def embed_images(self, html):
-        soup = BeautifulSoup(html, "html.parser")
+        soup = BeautifulSoup(html, HTML_PARSER)
 
         for img in soup.find_all("img"):
             src = img.get("src")
@@ -242,57 +424,64 @@ class EpubReader(QMainWindow):
 
     # PAGINATION
     def paginate_chapter(self, html):
-        soup = BeautifulSoup(html, "html.parser")
+        soup = BeautifulSoup(html, HTML_PARSER)
 
-        blocks = []
-        for elem in soup.find_all(["p", "div", "img", "h1", "h2", "h3", "h4"]):
-            blocks.append(str(elem))
+        elems = soup.find_all(["p", "div", "img", "h1", "h2", "h3", "h4"])
+        blocks = [str(elem) for elem in elems]
+        headings = ("h1", "h2", "h3", "h4")
 
-        pages = []
-        current = []
+        # Only record where each page starts; the page markup is joined
+        # from the blocks when it is displayed
+        starts = []
         length = 0
         max_length = 1800
 
-        for block in blocks:
+        for i, block in enumerate(blocks):
             block_len = len(block)
 
-            if length + block_len > max_length and current:
-                pages.append("".join(current))
-                current = []
-                length = 0
+            if not starts or (length + block_len > max_length and length):
+                # Don't leave a heading stranded at the bottom of a page
+                if starts and starts[-1] < i - 1 and elems[i - 1].name in headings:
+                    starts.append(i - 1)
+                    length = len(blocks[i - 1])
+                else:
+                    starts.append(i)
+                    length = 0
 
-            current.append(block)
             length += block_len
 
-        if current:
-            pages.append("".join(current))
+        return blocks, starts
 
-        return pages
+    def page_html(self, page):
+        html = self.page_html_cache.get(page)
+        if html is None:
+            start = self.page_starts[page]
+            end = self.page_starts[page + 1] if page + 1 < len(self.page_starts) else None
+            html = "".join(self.page_blocks[start:end])
+            self.page_html_cache[page] = html
+        return html
 
     # CHAPTER + PAGE HANDLING
     def load_chapter(self, index):
         if self.suppress_load:
             return
 
+        saved_page = self.restored_page
+        self.restored_page = 0
+
         if index < 0 or index >= len(self.chapters):
             return
 
         if self.current_book:
-            self.save_progress(self.current_book, index, 0)
+            self.schedule_progress_save(self.current_book, index, 0)
+
+        self.page_html_cache.clear()
 
         if self.chapters[index] == "__COVER__" and self.cover_data:
-            b64 = base64.b64encode(self.cover_data).decode("ascii")
-            html = f"""
-            <html>
-            <body style="background-color:#202020;">
-                <div style="text-align:center; margin-top:20px;">
-                    <img src="data:image/jpeg;base64,{b64}" style="max-width:90%; max-height:90%;" />
-                </div>
-            </body>
-            </html>
-            """
-            self.text_view.setHtml(html)
-            self.pages = []
+            self.show_cover()
+            self.footer_label.clear()
+            self.page_blocks = []
+            self.page_starts = []
             self.current_chapter = index
             self.current_page = 0
             return
@@ -300,57 +489,65 @@ class EpubReader(QMainWindow):
         self.current_chapter = index
         chapter_html = self.chapters[index]
 
-        self.pages = self.paginate_chapter(chapter_html)
+        self.page_blocks, self.page_starts = self.paginate_chapter(chapter_html)
 
-        _, saved_page = self.load_progress(self.current_book)
-        self.current_page = min(saved_page, len(self.pages) - 1)
+        self.current_page = min(saved_page, len(self.page_starts) - 1)
 
         self.display_page()
 
+    def show_cover(self):
+        self.scale_cover()
+        self.viewer_stack.setCurrentWidget(self.cover_label)
+
+    def scale_cover(self):
+        if self.cover_pixmap and not self.cover_pixmap.isNull():
+            self.cover_label.setPixmap(self.cover_pixmap.scaled(
+                self.cover_label.size() * 0.9, Qt.KeepAspectRatio, Qt.SmoothTransformation
+            ))
+
+    def eventFilter(self, obj, event):
+        if (obj is self.cover_label and event.type() == QEvent.Resize
+                and self.viewer_stack.currentWidget() is self.cover_label):
+            self.scale_cover()
+        return super().eventFilter(obj, event)
+
     def display_page(self):
-        if self.pages:
-            text = self.pages[self.current_page]
-            total = len(self.pages)
+        if self.page_starts:
+            total = len(self.page_starts)
             current = self.current_page + 1
 
-            html = f"""
-            <html>
-            <body>
-            <div>{text}</div>
-            <div style="text-align:center; margin-top:20px; font-weight:bold;">
-                Page {current} / {total}
-            </div>
-            </body>
-            </html>
-            """
-
-            self.text_view.setHtml(html)
+            self.viewer_stack.setCurrentWidget(self.text_view)
+            self.text_view.setHtml(self.page_html(self.current_page))
+            self.footer_label.setText(PAGE_LABEL % (current, total))
 
             if self.current_book:
-                self.save_progress(self.current_book, self.current_chapter, self.current_page)
+                self.schedule_progress_save(self.current_book, self.current_chapter, self.current_page)
 
     def next_page(self):
-        if self.pages and self.current_page < len(self.pages) - 1:
+        if self.page_starts and self.current_page < len(self.page_starts) - 1:
             self.current_page += 1
             self.display_page()
 
     def prev_page(self):
-        if self.pages and self.current_page > 0:
+        if self.page_starts and self.current_page > 0:
             self.current_page -= 1
             self.display_page()
 
     # FONT CONTROLS
     def increase_font(self):
         self.font_size += 2
-        self.text_view.setFont(QFont(self.font_selector.currentText(), self.font_size))
+        self.view_font.setPointSize(self.font_size)
+        self.text_view.setFont(self.view_font)
 
     def decrease_font(self):
         if self.font_size > 6:
             self.font_size -= 2
-            self.text_view.setFont(QFont(self.font_selector.currentText(), self.font_size))
+            self.view_font.setPointSize(self.font_size)
+            self.text_view.setFont(self.view_font)
 
     def change_font_family(self, family):
-        self.text_view.setFont(QFont(family, self.font_size))
+        self.view_font.setFamily(family)
+        self.text_view.setFont(self.view_font)
 
 
 if __name__ == "__main__":